@@ -11,17 +11,25 @@ from speechless.net import ExpectationsVsPredictionsInGroupedBatches
 from speechless.tools import log, distinct
 
 
-def restrict_gpu_memory(per_process_gpu_memory_fraction: float = 0.9):
+def restrict_gpu_memory(per_process_gpu_memory_fraction: float = 0.9, enable_xla_jit: bool = False):
     import os
     import tensorflow as tf
     import keras
     thread_count = os.environ.get('OMP_NUM_THREADS')
-    gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=per_process_gpu_memory_fraction)
-    config = tf.ConfigProto(gpu_options=gpu_options,
-                            allow_soft_placement=True,
-                            intra_op_parallelism_threads=thread_count) \
-        if thread_count else tf.ConfigProto(gpu_options=gpu_options, allow_soft_placement=True)
-    keras.backend.tensorflow_backend.set_session(tf.Session(config=config))
+    config_arguments = dict(
+        gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=per_process_gpu_memory_fraction),
+        allow_soft_placement=True)
+
+    if thread_count:
+        config_arguments["intra_op_parallelism_threads"] = thread_count
+
+    if enable_xla_jit:
+        # lets XLA fuse the convolution stack into larger kernels; worthwhile because the
+        # mel frequency count (and with it the weight shapes) is fixed per configuration:
+        config_arguments["graph_options"] = tf.GraphOptions(
+            optimizer_options=tf.OptimizerOptions(global_jit_level=tf.OptimizerOptions.ON_1))
+
+    keras.backend.tensorflow_backend.set_session(tf.Session(config=tf.ConfigProto(**config_arguments)))
 
 
 if __name__ == '__main__':
@@ -140,8 +148,15 @@ if __name__ == '__main__':
 
         example = german.corpus.examples[0]
 
-        for section in example.sections():
-            print(wav2letter.test_and_predict(section))
+        sections = example.sections()
+
+        # one batched graph call for all sections instead of a per-section loop
+        # (test_and_predict pads every single utterance to a batch of 2);
+        # batches of size 1 fail in the graph, see the workaround in test_and_predict:
+        if len(sections) == 1:
+            print(wav2letter.test_and_predict(sections[0]))
+        else:
+            print(wav2letter.test_and_predict_batch(sections))
 
 
     def run(use_kenlm=False, language_model_name_extension="",
@@ -191,10 +206,12 @@ if __name__ == '__main__':
         epochs = distinct(list(int(first_epoch + index * step_size) for index in range(step_count)))
         log("Testing model {} on epochs {}.".format(model_name, epochs))
 
+        # memoize=False: this model is re-weighted per epoch below and must not be shared
         model = configuration.load_model(model_name, last_epoch,
                                          allowed_characters_for_loaded_model=configuration.allowed_characters,
                                          use_kenlm=True,
-                                         language_model_name_extension="-incl-trans")
+                                         language_model_name_extension="-incl-trans",
+                                         memoize=False)
 
         def get_result(epoch: int) -> ExpectationsVsPredictionsInGroupedBatches:
             log("Testing epoch {}.".format(epoch))
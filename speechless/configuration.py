@@ -1,4 +1,7 @@
+import hashlib
 import logging
+import threading
+from functools import cached_property
 from pathlib import Path
 
 # removing this numpy import caused a segfault on startup of tensorflow-gpu 1.0
@@ -6,7 +9,6 @@ from pathlib import Path
 # noinspection PyUnresolvedReferences
 import numpy
 from collections import OrderedDict
-from lazy import lazy
 from typing import List, Callable, Optional
 
 from speechless.corpus import LabeledSpectrogramBatchGenerator, Corpus, ComposedCorpus
@@ -42,25 +44,65 @@ class Configuration:
                  directories: DataDirectories = default_data_directories,
                  mel_frequency_count: int = 128,
                  training_batches_per_epoch: int = 100,
-                 batch_size: int = 64):
+                 batch_size: int = 64,
+                 use_tf_dataset_cache: bool = False,
+                 length_bucket_boundaries: Optional[List[int]] = None):
         self.training_batches_per_epoch = training_batches_per_epoch
         self.mel_frequency_count = mel_frequency_count
         self.name = name
         self.directories = directories
         self.spectrogram_cache_directory = directories.spectrogram_cache_base_directory / name
+        self.use_tf_dataset_cache = use_tf_dataset_cache
         self.corpus_directory = directories.corpus_base_directory / name
         self.corpus_from_directory = corpus_from_directory
         self.allowed_characters = allowed_characters
         self.batch_size = batch_size
+        self.length_bucket_boundaries = length_bucket_boundaries
+        self._corpus_load_lock = threading.Lock()
+        self._models_by_load_parameters = dict()
 
-    @lazy
+    @cached_property
     def corpus(self) -> Corpus:
-        return self.corpus_from_directory(self.corpus_directory)
+        # Locked explicitly because prefetch_corpus may access this concurrently with the main thread
+        # (cached_property no longer locks the first materialization itself as of Python 3.12):
+        with self._corpus_load_lock:
+            if "corpus" in self.__dict__:
+                return self.__dict__["corpus"]
 
-    @lazy
+            # store under the lock: cached_property itself only writes to __dict__ after this
+            # getter returns, which would leave a window for a second load on another thread
+            corpus = self.corpus_from_directory(self.corpus_directory)
+            self.__dict__["corpus"] = corpus
+
+            return corpus
+
+    def prefetch_corpus(self) -> None:
+        """Starts loading the corpus on a background thread, so that it can overlap with building the net."""
+        threading.Thread(target=lambda: self.corpus, daemon=True).start()
+
+    @cached_property
     def batch_generator(self) -> LabeledSpectrogramBatchGenerator:
         return self.batch_generator_for_corpus(self.corpus)
 
+    @property
+    def tf_dataset_cache_directory(self) -> Path:
+        # The cached stream replays exactly the training examples it was written from, so their
+        # ids (and the mel frequency count) identify the directory; any change to the training
+        # list - sampling, corpus edits - thereby gets a fresh cache instead of silently
+        # replaying a stale one:
+        training_ids = "\n".join(s.id for s in self.batch_generator.labeled_training_spectrograms)
+
+        return self.spectrogram_cache_directory / "tf-dataset-cache-{}mel-{}".format(
+            self.mel_frequency_count, hashlib.sha1(training_ids.encode("utf8")).hexdigest()[:10])
+
+    def release_corpus(self) -> None:
+        """Drops the cached corpus once the batch generator is built from it,
+        freeing the corpus object and its example lists for the duration of training.
+        The corpus is reloaded transparently if accessed again."""
+        self.batch_generator
+
+        self.__dict__.pop("corpus", None)
+
     def batch_generator_for_corpus(self, corpus: Corpus) -> LabeledSpectrogramBatchGenerator:
         return LabeledSpectrogramBatchGenerator(corpus=corpus,
                                                 spectrogram_cache_directory=self.spectrogram_cache_directory,
@@ -94,14 +136,18 @@ class Configuration:
                 [Configuration.english().corpus, Configuration.german().corpus]))
 
     def train(self, wav2letter, run_name: str) -> None:
-        wav2letter.train(self.batch_generator.training_batches(),
-                         tensor_board_log_directory=self.directories.tensorboard_log_base_directory / run_name,
-                         net_directory=self.directories.nets_base_directory / run_name,
-                         preview_labeled_spectrogram_batch=self.batch_generator.preview_batch(),
-                         batches_per_epoch=self.training_batches_per_epoch)
+        self.release_corpus()
+
+        wav2letter.train_on_dataset(self.batch_generator.tf_dataset(
+            cache_directory=self.tf_dataset_cache_directory if self.use_tf_dataset_cache else None,
+            bucket_boundaries=self.length_bucket_boundaries),
+                                    tensor_board_log_directory=self.directories.tensorboard_log_base_directory / run_name,
+                                    net_directory=self.directories.nets_base_directory / run_name,
+                                    preview_labeled_spectrogram_batch=self.batch_generator.preview_batch(),
+                                    batches_per_epoch=self.training_batches_per_epoch)
 
     def train_from_beginning(self):
-        from speechless.net import Wav2Letter
+        self.prefetch_corpus()
 
         wav2letter = Wav2Letter(self.mel_frequency_count, allowed_characters=self.allowed_characters)
 
@@ -120,10 +166,23 @@ class Configuration:
     def fill_cache(self, repair_incorrect: bool = False):
         self.batch_generator.fill_cache(repair_incorrect=repair_incorrect)
 
+    def consolidate_cache(self):
+        self.batch_generator.consolidate_cache()
+
     def test_model(self, wav2letter):
         log(wav2letter.test_and_predict_batch(self.batch_generator.preview_batch()))
         log(wav2letter.test_and_predict_batches(self.batch_generator.test_batches()))
 
+    def test_model_loss(self, wav2letter) -> float:
+        """Computes the average test set loss in one streaming pass over the tf.data pipeline,
+        without decoding predictions; much cheaper than test_model when only the loss is needed."""
+        average_loss = wav2letter.average_loss_on_dataset(
+            self.batch_generator.tf_dataset(self.batch_generator.labeled_test_spectrograms, shuffle=False))
+
+        log("Average test loss: {:.2f}".format(average_loss))
+
+        return average_loss
+
     def test_model_grouped_by_loaded_corpus_name(self, wav2letter) -> ExpectationsVsPredictionsInGroupedBatches:
         def corpus_name(example: LabeledExampleFromFile) -> str:
             return example.audio_directory.relative_to(self.corpus_directory).parts[0]
@@ -140,16 +199,20 @@ class Configuration:
 
     def train_transfer_from_best_english_model(self, frozen_layer_count: int,
                                                reinitialize_trainable_loaded_layers: bool = False):
+        self.prefetch_corpus()
+
+        # never reuse (or leave behind) a memoized instance for training, which mutates the weights:
+        wav2letter = self.load_best_english_model(
+            frozen_layer_count=frozen_layer_count,
+            reinitialize_trainable_loaded_layers=reinitialize_trainable_loaded_layers,
+            memoize=False)
+
         run_name = timestamp() + "-adam-small-learning-rate-transfer-to-{}-freeze-{}{}{}".format(
             self.name, frozen_layer_count, "-reinitialize" if reinitialize_trainable_loaded_layers else "",
             self.sampled_training_example_count_extension())
 
         log("Run: " + run_name)
 
-        wav2letter = self.load_best_english_model(
-            frozen_layer_count=frozen_layer_count,
-            reinitialize_trainable_loaded_layers=reinitialize_trainable_loaded_layers)
-
         self.train(wav2letter, run_name=run_name)
 
     def sampled_training_example_count_extension(self):
@@ -163,29 +226,49 @@ class Configuration:
                    allowed_characters_for_loaded_model: List[chr] = english_frequent_characters,
                    use_kenlm: bool = False,
                    reinitialize_trainable_loaded_layers: bool = False,
-                   language_model_name_extension: str = ""):
-        from speechless.net import Wav2Letter
-        return Wav2Letter(
-            allowed_characters=self.allowed_characters,
-            input_size_per_time_step=self.mel_frequency_count,
-            load_model_from_directory=self.directories.nets_base_directory / load_name,
-            load_epoch=load_epoch,
-            allowed_characters_for_loaded_model=allowed_characters_for_loaded_model,
-            frozen_layer_count=frozen_layer_count,
-            kenlm_directory=(
-                self.directories.kenlm_base_directory / (
-                    self.name.lower() + language_model_name_extension)) if use_kenlm else None,
-            reinitialize_trainable_loaded_layers=reinitialize_trainable_loaded_layers)
+                   language_model_name_extension: str = "",
+                   kenlm_beam_width: int = 100,
+                   memoize: bool = True):
+        """Memoized models are shared between callers and must be treated read-only;
+        pass memoize=False when the model will be trained or re-weighted afterwards."""
+        load_parameters = (load_name, load_epoch, frozen_layer_count,
+                           None if allowed_characters_for_loaded_model is None else
+                           tuple(allowed_characters_for_loaded_model),
+                           use_kenlm, reinitialize_trainable_loaded_layers, language_model_name_extension,
+                           kenlm_beam_width)
+
+        model = self._models_by_load_parameters.get(load_parameters) if memoize else None
+
+        if model is None:
+            model = Wav2Letter(
+                allowed_characters=self.allowed_characters,
+                input_size_per_time_step=self.mel_frequency_count,
+                load_model_from_directory=self.directories.nets_base_directory / load_name,
+                load_epoch=load_epoch,
+                allowed_characters_for_loaded_model=allowed_characters_for_loaded_model,
+                frozen_layer_count=frozen_layer_count,
+                kenlm_directory=(
+                    self.directories.kenlm_base_directory / (
+                        self.name.lower() + language_model_name_extension)) if use_kenlm else None,
+                kenlm_beam_width=kenlm_beam_width,
+                reinitialize_trainable_loaded_layers=reinitialize_trainable_loaded_layers)
+
+            if memoize:
+                self._models_by_load_parameters[load_parameters] = model
+
+        return model
 
     def load_best_english_model(self,
                                 frozen_layer_count: int = 0,
                                 use_ken_lm: bool = False,
-                                reinitialize_trainable_loaded_layers: bool = False):
+                                reinitialize_trainable_loaded_layers: bool = False,
+                                memoize: bool = True):
         return self.load_model(
             load_name=Configuration.english_baseline[0], load_epoch=Configuration.english_baseline[1],
             frozen_layer_count=frozen_layer_count,
             use_kenlm=use_ken_lm,
-            reinitialize_trainable_loaded_layers=reinitialize_trainable_loaded_layers)
+            reinitialize_trainable_loaded_layers=reinitialize_trainable_loaded_layers,
+            memoize=memoize)
 
     def test_best_english_model(self, use_kenlm: bool = False):
         self.test_model_grouped_by_loaded_corpus_name(self.load_best_english_model(use_ken_lm=use_kenlm))
@@ -1,15 +1,17 @@
 import multiprocessing
 import random
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
-from multiprocessing.pool import Pool
 from pathlib import Path
 
+import numpy
 from collections import OrderedDict
+from numpy import ndarray
 from typing import List, Iterable, Callable, Tuple, Any, Optional, TypeVar, Dict
 
 from speechless.labeled_example import LabeledExample, LabeledSpectrogram, CachedLabeledSpectrogram, \
-    LabeledExampleFromFile, PositionalLabel
+    LabeledExampleFromFile, PositionalLabel, SpectrogramCacheShard
 from speechless.tools import group, paginate, mkdir, duplicates, log
 
 
@@ -22,6 +24,45 @@ class Phase(Enum):
     test = "test"
 
 
+def _write_csv(csv_file: Path, rows: List[Iterable[Any]]) -> None:
+    """Writes rows of values as csv, through pyarrow's native writer where possible
+    (orders of magnitude faster for large corpora than the per-row Python csv writer)."""
+    rows = [tuple(str(value) for value in row) for row in rows]
+    column_counts = set(len(row) for row in rows)
+
+    def write_with_stdlib():
+        import csv
+        with csv_file.open('w', encoding='utf8') as opened_csv:
+            writer = csv.writer(opened_csv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+            for row in rows:
+                writer.writerow(row)
+
+    try:
+        import pyarrow
+        from pyarrow import csv as arrow_csv
+    except ImportError:
+        pyarrow = None
+
+    if pyarrow is None or len(column_counts) != 1:
+        # no pyarrow installed, or ragged/empty rows, which only the stdlib writer handles:
+        write_with_stdlib()
+        return
+
+    try:
+        # quoting_style needs pyarrow >= 8, older versions raise TypeError:
+        write_options = arrow_csv.WriteOptions(include_header=False, quoting_style="needed")
+    except TypeError:
+        write_with_stdlib()
+        return
+
+    column_count = column_counts.pop()
+    table = pyarrow.table([pyarrow.array([row[index] for row in rows]) for index in range(column_count)],
+                          names=[str(index) for index in range(column_count)])
+
+    arrow_csv.write_csv(table, str(csv_file), write_options)
+
+
 class Corpus:
     __metaclass__ = ABCMeta
 
@@ -62,49 +103,45 @@ class Corpus:
         raise NotImplementedError
 
     def summarize_to_csv(self, summary_csv_file: Path) -> None:
-        import csv
-        with summary_csv_file.open('w', encoding='utf8') as csv_summary_file:
-            writer = csv.writer(csv_summary_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-
-            for row in self.csv_rows():
-                writer.writerow(row)
+        _write_csv(summary_csv_file, self.csv_rows())
 
     def save(self, corpus_csv_file: Path, use_relative_audio_file_paths: bool = True):
-        import csv
-        with corpus_csv_file.open('w', encoding='utf8') as opened_csv:
-            writer = csv.writer(opened_csv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-
-            examples_and_phase = [(e, Phase.training) for e in self.training_examples] + \
-                                 [(e, Phase.test) for e in self.test_examples]
+        examples_and_phase = [(e, Phase.training) for e in self.training_examples] + \
+                             [(e, Phase.test) for e in self.test_examples]
 
-            for e, phase in examples_and_phase:
-                writer.writerow(
-                    (e.id, str(e.audio_file.relative_to(
-                        corpus_csv_file.parent) if use_relative_audio_file_paths else e.audio_file),
-                     e.label, phase.value, e.positional_label.serialize() if e.positional_label else ""))
+        _write_csv(corpus_csv_file, [
+            (e.id, str(e.audio_file.relative_to(
+                corpus_csv_file.parent) if use_relative_audio_file_paths else e.audio_file),
+             e.label, phase.value, e.positional_label.serialize() if e.positional_label else "")
+            for e, phase in examples_and_phase])
 
     @staticmethod
     def load(corpus_csv_file: Path,
              sampled_training_example_count: Optional[int] = None) -> 'Corpus':
-        import csv
-        with corpus_csv_file.open(encoding='utf8') as opened_csv:
-            reader = csv.reader(opened_csv, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-
-            def to_absolute(audio_file_path: Path) -> Path:
-                return audio_file_path if audio_file_path.is_absolute() else Path(
-                    corpus_csv_file.parent) / audio_file_path
-
-            examples = [
-                (
-                    LabeledExampleFromFile(
-                        audio_file=to_absolute(Path(audio_file_path)), id=id, label=label,
-                        positional_label=None if positional_label == "" else PositionalLabel.deserialize(
-                            positional_label)), Phase[phase])
-                for id, audio_file_path, label, phase, positional_label in reader]
-
-            return Corpus(training_examples=[e for e, phase in examples if phase == Phase.training],
-                          test_examples=[e for e, phase in examples if phase == Phase.test],
-                          sampled_training_example_count=sampled_training_example_count)
+        import pandas
+
+        def to_absolute(audio_file_path: Path) -> Path:
+            return audio_file_path if audio_file_path.is_absolute() else Path(
+                corpus_csv_file.parent) / audio_file_path
+
+        # pandas' C engine with a fixed string dtype parses the corpus csv much faster
+        # than a per-row Python loop with the csv module:
+        rows = pandas.read_csv(str(corpus_csv_file), sep=',', quotechar='"', engine='c', encoding='utf8',
+                               header=None, names=("id", "audio_file_path", "label", "phase", "positional_label"),
+                               dtype=str, na_filter=False)
+
+        examples = [
+            (
+                LabeledExampleFromFile(
+                    audio_file=to_absolute(Path(audio_file_path)), id=id, label=label,
+                    positional_label=None if positional_label == "" else PositionalLabel.deserialize(
+                        positional_label)), Phase[phase])
+            for id, audio_file_path, label, phase, positional_label in
+            zip(rows.id, rows.audio_file_path, rows.label, rows.phase, rows.positional_label)]
+
+        return Corpus(training_examples=[e for e, phase in examples if phase == Phase.training],
+                      test_examples=[e for e, phase in examples if phase == Phase.test],
+                      sampled_training_example_count=sampled_training_example_count)
 
     K = TypeVar('Key')
 
@@ -194,12 +231,23 @@ class TrainingTestSplit:
         return split
 
 
-def _cache_spectrogram(labeled_spectrogram: CachedLabeledSpectrogram) -> None:
-    labeled_spectrogram.z_normalized_transposed_spectrogram()
+def _fill_cache_worker(work_item: Tuple) -> None:
+    """Runs in a worker process; reconstructs the example from plain picklable values
+    (the wrapper objects hold an unpicklable audio-loading closure)."""
+    (audio_file, id, sample_rate, fourier_window_length, hop_length, mel_frequency_count,
+     spectrogram_cache_directory, repair_incorrect) = work_item
 
+    labeled_spectrogram = CachedLabeledSpectrogram(
+        LabeledExampleFromFile(audio_file=audio_file, id=id,
+                               sample_rate_to_convert_to=sample_rate,
+                               fourier_window_length=fourier_window_length, hop_length=hop_length,
+                               mel_frequency_count=mel_frequency_count),
+        spectrogram_cache_directory=spectrogram_cache_directory)
 
-def _repair_cached_spectrogram_if_incorrect(labeled_spectrogram: CachedLabeledSpectrogram) -> None:
-    labeled_spectrogram.repair_cached_file_if_incorrect()
+    if repair_incorrect:
+        labeled_spectrogram.repair_cached_file_if_incorrect()
+    else:
+        labeled_spectrogram.z_normalized_transposed_spectrogram()
 
 
 class LabeledSpectrogramBatchGenerator:
@@ -208,38 +256,146 @@ class LabeledSpectrogramBatchGenerator:
 
         self.batch_size = batch_size
         self.spectrogram_cache_directory = spectrogram_cache_directory
+
+        shard = SpectrogramCacheShard.load_if_exists(spectrogram_cache_directory)
+
         self.labeled_training_spectrograms = [
-            CachedLabeledSpectrogram(example, spectrogram_cache_directory=spectrogram_cache_directory)
+            CachedLabeledSpectrogram(example, spectrogram_cache_directory=spectrogram_cache_directory, shard=shard)
             for example in corpus.training_examples]
 
         self.labeled_test_spectrograms = [
-            CachedLabeledSpectrogram(example, spectrogram_cache_directory=spectrogram_cache_directory)
+            CachedLabeledSpectrogram(example, spectrogram_cache_directory=spectrogram_cache_directory, shard=shard)
             for example in corpus.test_examples]
 
         self.labeled_spectrograms = self.labeled_training_spectrograms + self.labeled_test_spectrograms
+        self._preview_batch = None
 
     def preview_batch(self) -> List[LabeledSpectrogram]:
-        return self.labeled_spectrograms[:self.batch_size]
+        if self._preview_batch is None:
+            self._preview_batch = self.labeled_spectrograms[:self.batch_size]
+
+        return self._preview_batch
 
     def training_batches(self) -> Iterable[List[LabeledSpectrogram]]:
         while True:
             yield random.sample(self.labeled_training_spectrograms, self.batch_size)
 
+    def tf_dataset(self, labeled_spectrograms: Optional[List[LabeledSpectrogram]] = None,
+                   shuffle: bool = True,
+                   cache_directory: Optional[Path] = None,
+                   bucket_boundaries: Optional[List[int]] = None) -> 'tf.data.Dataset':
+        """
+        Returns a dataset of padded batches in shape
+        ((batch, time, frequencies), (batch,), (batch,)),
+        containing spectrograms, their lengths in time steps and their utf8-encoded labels.
+        Spectrograms are loaded in parallel and batches are prefetched,
+        so that preprocessing overlaps with training or decoding on the GPU
+        instead of stalling it (as feeding batches from a Python generator does).
+
+        If cache_directory is given, loaded spectrograms are additionally cached there
+        in tensorflow's own format, so that epochs after the first stream raw tensors
+        from disk instead of opening one file per example.
+
+        If bucket_boundaries (in time steps) are given, examples of similar length are
+        batched together, so short utterances are not padded up to the longest utterance
+        of an arbitrary batch - the net spends compute on every padded time step.
+        """
+        import tensorflow as tf
+
+        if labeled_spectrograms is None:
+            labeled_spectrograms = self.labeled_training_spectrograms
+
+        parallelism = self._tf_dataset_parallelism()
+
+        def load(index: ndarray) -> Tuple[ndarray, ndarray, bytes]:
+            labeled_spectrogram = labeled_spectrograms[int(index)]
+            spectrogram = labeled_spectrogram.z_normalized_transposed_spectrogram().astype(numpy.float32)
+            return spectrogram, numpy.int32(spectrogram.shape[0]), labeled_spectrogram.label.encode("utf8")
+
+        def load_op(index):
+            spectrogram, length, label = tf.py_func(load, [index], [tf.float32, tf.int32, tf.string])
+            spectrogram.set_shape([None, None])
+            length.set_shape([])
+            label.set_shape([])
+            return spectrogram, length, label
+
+        indices = tf.data.Dataset.from_tensor_slices(list(range(len(labeled_spectrograms))))
+
+        if cache_directory is None:
+            if shuffle:
+                indices = indices.shuffle(buffer_size=len(labeled_spectrograms)).repeat()
+
+            dataset = indices.map(load_op, num_parallel_calls=parallelism)
+        else:
+            # The cache must be written in one deterministic pass over all examples,
+            # so examples are cached before shuffling and shuffled in a buffer afterwards:
+            mkdir(cache_directory)
+            dataset = indices. \
+                map(load_op, num_parallel_calls=parallelism). \
+                cache(str(cache_directory / "spectrograms"))
+
+            if shuffle:
+                dataset = dataset.shuffle(buffer_size=10 * self.batch_size).repeat()
+
+        if bucket_boundaries is None:
+            dataset = dataset.padded_batch(self.batch_size, padded_shapes=([None, None], [], []))
+        else:
+            dataset = dataset.apply(tf.data.experimental.bucket_by_sequence_length(
+                element_length_func=lambda spectrogram, length, label: length,
+                bucket_boundaries=bucket_boundaries,
+                bucket_batch_sizes=[self.batch_size] * (len(bucket_boundaries) + 1),
+                padded_shapes=([None, None], [], [])))
+
+        return dataset.prefetch(parallelism)
+
+    @staticmethod
+    def _tf_dataset_parallelism() -> int:
+        import tensorflow as tf
+
+        try:
+            return tf.data.experimental.AUTOTUNE
+        except AttributeError:
+            return multiprocessing.cpu_count()
+
     def test_batches(self) -> Iterable[List[LabeledSpectrogram]]:
         return paginate(self.labeled_test_spectrograms, self.batch_size)
 
+    def consolidate_cache(self) -> None:
+        """Consolidates all cached spectrograms into one memory-mapped shard file,
+        which is then read preferentially. Run fill_cache first so spectrograms are not computed here."""
+        log("Consolidating {} spectrograms into {}.".format(
+            len(self.labeled_spectrograms), SpectrogramCacheShard.shard_file_name))
+
+        shard = SpectrogramCacheShard.write(self.labeled_spectrograms, self.spectrogram_cache_directory)
+
+        for labeled_spectrogram in self.labeled_spectrograms:
+            labeled_spectrogram.shard = shard
+
     def fill_cache(self, repair_incorrect: bool = False) -> None:
-        with Pool(processes=multiprocessing.cpu_count()) as pool:
-            total = len(self.labeled_spectrograms)
-            not_yet_cached = [s for s in self.labeled_spectrograms if not s.is_cached()]
+        total = len(self.labeled_spectrograms)
+        not_yet_cached = [s for s in self.labeled_spectrograms if not s.is_cached()]
+
+        to_calculate = self.labeled_spectrograms if repair_incorrect else not_yet_cached
+
+        log("Filling cache with {} spectrograms: {} already cached, {} to calculate.".format(
+            total, total - len(not_yet_cached), len(to_calculate)))
+
+        if not to_calculate:
+            return
 
-            to_calculate = self.labeled_spectrograms if repair_incorrect else not_yet_cached
+        process_count = multiprocessing.cpu_count()
+        work_items = [self._fill_cache_work_item(labeled_spectrogram, repair_incorrect=repair_incorrect)
+                      for labeled_spectrogram in to_calculate]
 
-            log("Filling cache with {} spectrograms: {} already cached, {} to calculate.".format(
-                total, total - len(not_yet_cached), len(to_calculate)))
-            for index, labeled_spectrogram in enumerate(to_calculate):
-                pool.apply_async(_repair_cached_spectrogram_if_incorrect if repair_incorrect else _cache_spectrogram,
-                                 (labeled_spectrogram,))
+        with ProcessPoolExecutor(max_workers=process_count) as executor:
+            # a chunked map sends many examples per worker round trip
+            # instead of one message per spectrogram as apply_async did,
+            # and unlike apply_async surfaces worker exceptions instead of swallowing them:
+            for _ in executor.map(_fill_cache_worker, work_items,
+                                  chunksize=max(1, len(work_items) // (10 * process_count))):
+                pass
 
-            pool.close()
-            pool.join()
+    def _fill_cache_work_item(self, labeled_spectrogram: CachedLabeledSpectrogram, repair_incorrect: bool) -> Tuple:
+        original = labeled_spectrogram.original
+        return (original.audio_file, original.id, original.sample_rate, original.fourier_window_length,
+                original.hop_length, original.mel_frequency_count, self.spectrogram_cache_directory, repair_incorrect)
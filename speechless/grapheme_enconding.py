@@ -4,6 +4,10 @@ from itertools import groupby
 from numpy import argmax, ones, ndarray, array
 from typing import List
 
+# graphemes are represented by private use area characters during translation,
+# a code point range no real label character occupies:
+_grapheme_code_point_base = 0xE000
+
 
 class GraphemeEncodingBase:
     def __init__(self, allowed_characters: List[chr], special_grapheme_count: int):
@@ -12,12 +16,27 @@ class GraphemeEncodingBase:
         self.grapheme_set_size = self.allowed_character_count + special_grapheme_count
         self.graphemes_by_character = dict((char, index) for index, char in enumerate(allowed_characters))
 
+        # precompiled table to run the per-character lookup in C via str.translate:
+        self._grapheme_translation_table = str.maketrans(
+            dict((char, chr(_grapheme_code_point_base + index)) for index, char in enumerate(allowed_characters)))
+
     def encode_character(self, label_char: chr) -> int:
         try:
             return self.graphemes_by_character[label_char]
         except:
             raise ValueError("Unexpected char: '{}'".format(label_char))
 
+    def _encode_characters(self, label: str) -> List[int]:
+        graphemes = [ord(translated) - _grapheme_code_point_base
+                     for translated in label.translate(self._grapheme_translation_table)]
+
+        # unexpected characters pass through translate unchanged and land outside the grapheme range;
+        # re-encode character by character in that case to raise the informative error:
+        if any(grapheme < 0 or grapheme >= self.allowed_character_count for grapheme in graphemes):
+            return [self.encode_character(character) for character in label]
+
+        return graphemes
+
     @abstractmethod
     def encode(self, label: str) -> List[int]:
         pass
@@ -69,7 +88,7 @@ class AsgGraphemeEncoding(GraphemeEncodingBase):
         self.asg_thrice = self.grapheme_set_size - 1
 
     def encode(self, label: str) -> List[int]:
-        naive_encoded = [self.encode_character(c) for c in label]
+        naive_encoded = self._encode_characters(label)
 
         def repetition_count_after(index: int) -> int:
             original_grapheme = naive_encoded[index]
@@ -126,7 +145,7 @@ class CtcGraphemeEncoding(GraphemeEncodingBase):
         self.ctc_blank = self.grapheme_set_size - 1
 
     def encode(self, label: str) -> List[int]:
-        return [self.encode_character(c) for c in label]
+        return self._encode_characters(label)
 
     def decode_grapheme(self, grapheme: int, previous_grapheme: int) -> str:
         if grapheme in range(self.allowed_character_count):
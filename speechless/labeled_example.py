@@ -9,10 +9,20 @@ import numpy
 import os
 from lazy import lazy
 from numpy import ndarray, mean, std, vectorize, dot
-from typing import List, Optional, Tuple, Callable
+from typing import List, Optional, Tuple, Callable, Dict
 
 from speechless.tools import name_without_extension, mkdir, write_text, log
 
+# librosa computes the STFT with numpy.fft by default; scipy's pocketfft backend is
+# considerably faster for the many repeated 512-point transforms, so use it where available:
+try:
+    import scipy.fft
+
+    librosa.set_fftlib(scipy.fft)
+except (ImportError, AttributeError):
+    # older scipy without the pocketfft module, or older librosa without set_fftlib
+    pass
+
 
 class SpectrogramFrequencyScale(Enum):
     linear = "linear"
@@ -26,7 +36,10 @@ class SpectrogramType(Enum):
 
 
 def z_normalize(array: ndarray) -> ndarray:
-    return (array - mean(array)) / std(array)
+    # Fused into a single float32 output buffer (instead of (array - mean) / std with two temporaries),
+    # as this operation is memory-bound on whole spectrograms:
+    normalized = numpy.subtract(array, mean(array), dtype=numpy.float32)
+    return numpy.divide(normalized, std(array), out=normalized)
 
 
 class PositionalLabel:
@@ -110,9 +123,18 @@ class LabeledExample(LabeledSpectrogram):
         return librosa.mel_frequencies(self.mel_frequency_count + 2, fmax=self.sample_rate / 2)
 
     def _convert_spectrogram_to_mel_scale(self, linear_frequency_spectrogram: ndarray) -> ndarray:
-        return dot(
-            librosa.filters.mel(sr=self.sample_rate, n_fft=self.fourier_window_length, n_mels=self.mel_frequency_count),
-            linear_frequency_spectrogram)
+        try:
+            from speechless import fast_mel
+        except ImportError:
+            return dot(
+                librosa.filters.mel(sr=self.sample_rate, n_fft=self.fourier_window_length,
+                                    n_mels=self.mel_frequency_count),
+                linear_frequency_spectrogram)
+
+        return fast_mel.mel_spectrogram(linear_frequency_spectrogram,
+                                        sample_rate=self.sample_rate,
+                                        fourier_window_length=self.fourier_window_length,
+                                        mel_frequency_count=self.mel_frequency_count)
 
     def highest_detectable_frequency(self) -> float:
         return self.sample_rate / 2
@@ -233,13 +255,82 @@ class LabeledExampleFromFile(LabeledExample):
         return [section(label, start, end) for label, (start, end) in self.positional_label.labeled_sections]
 
 
+class SpectrogramCacheShard:
+    """
+    A single memory-mapped file containing all cached spectrograms of a corpus,
+    concatenated along the time axis, together with an index from example ids to row ranges.
+    Reading a spectrogram from the shard is a slice of the memory map,
+    eliminating the per-example file open that the one-npy-file-per-example cache pays on every batch.
+    """
+
+    shard_file_name = "spectrogram-shard.npy"
+    index_file_name = "spectrogram-shard-index.npz"
+
+    def __init__(self, spectrograms: ndarray, row_ranges_by_id: Dict[str, Tuple[int, int]]):
+        self.spectrograms = spectrograms
+        self.row_ranges_by_id = row_ranges_by_id
+
+    def contains(self, id: str) -> bool:
+        return id in self.row_ranges_by_id
+
+    def spectrogram(self, id: str) -> ndarray:
+        start, row_count = self.row_ranges_by_id[id]
+        return self.spectrograms[start:start + row_count]
+
+    @staticmethod
+    def load_if_exists(directory: Path) -> Optional['SpectrogramCacheShard']:
+        shard_file = directory / SpectrogramCacheShard.shard_file_name
+        index_file = directory / SpectrogramCacheShard.index_file_name
+
+        if not shard_file.exists() or not index_file.exists():
+            return None
+
+        with numpy.load(str(index_file)) as index:
+            row_ranges_by_id = dict(zip(index["ids"], zip(index["starts"], index["row_counts"])))
+
+        return SpectrogramCacheShard(numpy.load(str(shard_file), mmap_mode='r'), row_ranges_by_id)
+
+    @staticmethod
+    def write(labeled_spectrograms: List[LabeledSpectrogram], directory: Path) -> 'SpectrogramCacheShard':
+        from numpy.lib.format import open_memmap
+
+        spectrogram_shapes = [s.z_normalized_transposed_spectrogram().shape for s in labeled_spectrograms]
+        row_counts = [shape[0] for shape in spectrogram_shapes]
+
+        starts = []
+        total_row_count = 0
+        for row_count in row_counts:
+            starts.append(total_row_count)
+            total_row_count += row_count
+
+        first = labeled_spectrograms[0].z_normalized_transposed_spectrogram()
+        shard = open_memmap(str(directory / SpectrogramCacheShard.shard_file_name), mode='w+',
+                            dtype=first.dtype, shape=(total_row_count, first.shape[1]))
+
+        for labeled_spectrogram, start, row_count in zip(labeled_spectrograms, starts, row_counts):
+            shard[start:start + row_count] = labeled_spectrogram.z_normalized_transposed_spectrogram()
+
+        shard.flush()
+
+        numpy.savez(str(directory / SpectrogramCacheShard.index_file_name),
+                    ids=[s.id for s in labeled_spectrograms], starts=starts, row_counts=row_counts)
+
+        return SpectrogramCacheShard(shard, dict(zip((s.id for s in labeled_spectrograms),
+                                                     zip(starts, row_counts))))
+
+
 class CachedLabeledSpectrogram(LabeledSpectrogram):
-    def __init__(self, original: LabeledSpectrogram, spectrogram_cache_directory: Path):
+    def __init__(self, original: LabeledSpectrogram, spectrogram_cache_directory: Path,
+                 shard: Optional[SpectrogramCacheShard] = None):
         super().__init__(id=original.id, label=original.label)
         self.original = original
+        self.shard = shard
         self.spectrogram_cache_file = spectrogram_cache_directory / "{}.npy".format(original.id)
 
     def z_normalized_transposed_spectrogram(self) -> ndarray:
+        if self.shard is not None and self.shard.contains(self.id):
+            return self.shard.spectrogram(self.id)
+
         if not self.is_cached():
             return self._calculate_and_save_spectrogram()
 
@@ -258,11 +349,24 @@ class CachedLabeledSpectrogram(LabeledSpectrogram):
         return spectrogram
 
     def _save_to_cache(self, spectrogram: ndarray):
-        numpy.save(str(self.spectrogram_cache_file), spectrogram)
+        # float16 halves cache size and read bandwidth; z-normalized spectrograms stay within
+        # a few standard deviations of 0, where float16 resolution is far finer than the
+        # tolerance the repair check allows:
+        numpy.save(str(self.spectrogram_cache_file), spectrogram.astype(numpy.float16, copy=False))
 
     def is_cached(self):
+        if self.shard is not None and self.shard.contains(self.id):
+            return True
+
         return self.spectrogram_cache_file.exists()
 
+    def __getstate__(self):
+        # never serialize the shard (a memory map of the whole corpus) when these objects
+        # are pickled into worker processes:
+        state = self.__dict__.copy()
+        state["shard"] = None
+        return state
+
     def repair_cached_file_if_incorrect(self):
         if not self.is_cached():
             self._calculate_and_save_spectrogram()
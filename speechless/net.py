@@ -139,12 +139,14 @@ class Wav2Letter:
                  use_asg: bool = False,
                  asg_transition_probabilities: Optional[ndarray] = None,
                  asg_initial_probabilities: Optional[ndarray] = None,
-                 kenlm_directory: Path = None):
+                 kenlm_directory: Path = None,
+                 kenlm_beam_width: int = 100):
 
         if frozen_layer_count > 0 and load_model_from_directory is None:
             raise ValueError("Layers cannot be frozen if model is trained from scratch.")
 
         self.kenlm_directory = kenlm_directory
+        self.kenlm_beam_width = kenlm_beam_width
         self.grapheme_encoding = AsgGraphemeEncoding(allowed_characters=allowed_characters) \
             if use_asg else CtcGraphemeEncoding(allowed_characters=allowed_characters)
 
@@ -442,9 +444,12 @@ class Wav2Letter:
         # ctc_beam_search_decoder is called with merge_repeated=False,
         # while ctc_greedy_decoder is called with merge_repeated=True (see test_ctc_decoders.py for explanation):
         if self.kenlm_directory is not None:
+            # beam_width bounds how many prefixes are scored against the language model per time step,
+            # which dominates decoding time; narrower beams trade accuracy for speed:
             return tf.nn.ctc_beam_search_decoder(inputs=log_prediction_batch,
                                                  sequence_length=prediction_length_batch,
                                                  merge_repeated=False,
+                                                 beam_width=self.kenlm_beam_width,
                                                  kenlm_directory_path=str(self.kenlm_directory),
                                                  kenlm_weight=.8,
                                                  word_count_weight=0,
@@ -458,6 +463,27 @@ class Wav2Letter:
         return backend.function(self.loss_net.inputs + [backend.learning_phase()],
                                 [single(self.decoding_net.outputs), single(self.loss_net.outputs)])
 
+    @lazy
+    def get_loss_batch(self):
+        return backend.function(self.loss_net.inputs + [backend.learning_phase()], self.loss_net.outputs)
+
+    def average_loss_on_dataset(self, labeled_spectrogram_dataset) -> float:
+        """Accumulates the average example loss over a finite dataset
+        (as returned by LabeledSpectrogramBatchGenerator.tf_dataset with shuffle=False)
+        in one streaming pass, without decoding and without building per-example result objects."""
+        total_loss = 0.
+        example_count = 0
+
+        for input_dictionary, _ in self._loss_inputs_generator_from_dataset(labeled_spectrogram_dataset):
+            loss_batch = single(self.get_loss_batch(
+                [input_dictionary[input.name.split(":")[0]] for input in self.loss_net.inputs] +
+                [self.prediction_phase_flag]))
+
+            total_loss += float(numpy.sum(loss_batch))
+            example_count += loss_batch.shape[0]
+
+        return total_loss / example_count if example_count else float('nan')
+
     def test_and_predict_batch(self, labeled_spectrogram_batch: List[LabeledSpectrogram]) -> ExpectationsVsPredictions:
         input_by_name, dummy_labels = self._inputs_for_loss_net(labeled_spectrogram_batch)
 
@@ -502,6 +528,43 @@ class Wav2Letter:
         for labeled_spectrogram_batch in labeled_spectrogram_batches:
             yield self._inputs_for_loss_net(labeled_spectrogram_batch)
 
+    def _loss_inputs_generator_from_dataset(self, labeled_spectrogram_dataset) -> Iterable[Tuple[Dict, ndarray]]:
+        """Yields loss net inputs from a dataset as returned by LabeledSpectrogramBatchGenerator.tf_dataset."""
+        import tensorflow as tf
+
+        next_batch = labeled_spectrogram_dataset.make_one_shot_iterator().get_next()
+        session = backend.get_session()
+
+        while True:
+            try:
+                input_batch, spectrogram_lengths, label_batch = session.run(next_batch)
+            except tf.errors.OutOfRangeError:
+                return
+
+            labels = [label.decode("utf8") for label in label_batch]
+
+            yield self._inputs_for_loss_net_from_batch(input_batch, spectrogram_lengths, labels)
+
+    def _inputs_for_loss_net_from_batch(self, input_batch: ndarray, spectrogram_lengths: Iterable[int],
+                                        labels: List[str]) -> Tuple[Dict[str, ndarray], ndarray]:
+        batch_size = input_batch.shape[0]
+        prediction_lengths = [length // self.input_to_prediction_length_ratio for length in spectrogram_lengths]
+        label_lengths = reshape(array([len(label) for label in labels]), (batch_size, 1))
+
+        # Sets learning phase to training to enable dropout (see backend.learning_phase documentation for more info):
+        training_phase_flag_tensor = array([True])
+        input_dictionary = {
+            Wav2Letter.InputNames.input_batch: input_batch,
+            Wav2Letter.InputNames.prediction_lengths: self._prediction_length_batch(prediction_lengths,
+                                                                                    batch_size=batch_size),
+            Wav2Letter.InputNames.label_batch: self.grapheme_encoding.encode_label_batch(labels),
+            Wav2Letter.InputNames.label_lengths: label_lengths,
+            'keras_learning_phase': training_phase_flag_tensor
+        }
+
+        dummy_labels_for_dummy_loss_function = zeros((batch_size,))
+        return input_dictionary, dummy_labels_for_dummy_loss_function
+
     def _inputs_for_loss_net(self, labeled_spectrogram_batch: List[LabeledSpectrogram]) -> Tuple[
         Dict[str, ndarray], ndarray]:
         batch_size = len(labeled_spectrogram_batch)
@@ -544,10 +607,36 @@ class Wav2Letter:
               tensor_board_log_directory: Path,
               net_directory: Path,
               batches_per_epoch: int):
+        self._fit(self._loss_inputs_generator(labeled_spectrogram_batches),
+                  preview_labeled_spectrogram_batch=preview_labeled_spectrogram_batch,
+                  tensor_board_log_directory=tensor_board_log_directory,
+                  net_directory=net_directory,
+                  batches_per_epoch=batches_per_epoch)
+
+    def train_on_dataset(self,
+                         labeled_spectrogram_dataset,
+                         preview_labeled_spectrogram_batch: List[LabeledSpectrogram],
+                         tensor_board_log_directory: Path,
+                         net_directory: Path,
+                         batches_per_epoch: int):
+        """Trains on a dataset as returned by LabeledSpectrogramBatchGenerator.tf_dataset,
+        allowing tensorflow to load and preprocess spectrograms in parallel to training itself."""
+        self._fit(self._loss_inputs_generator_from_dataset(labeled_spectrogram_dataset),
+                  preview_labeled_spectrogram_batch=preview_labeled_spectrogram_batch,
+                  tensor_board_log_directory=tensor_board_log_directory,
+                  net_directory=net_directory,
+                  batches_per_epoch=batches_per_epoch)
+
+    def _fit(self,
+             loss_inputs: Iterable[Tuple[Dict, ndarray]],
+             preview_labeled_spectrogram_batch: List[LabeledSpectrogram],
+             tensor_board_log_directory: Path,
+             net_directory: Path,
+             batches_per_epoch: int):
         print_preview_batch = lambda: log(self.test_and_predict_batch(preview_labeled_spectrogram_batch))
 
         print_preview_batch()
-        self.loss_net.fit_generator(self._loss_inputs_generator(labeled_spectrogram_batches), epochs=100000000,
+        self.loss_net.fit_generator(loss_inputs, epochs=100000000,
                                     steps_per_epoch=batches_per_epoch,
                                     callbacks=self.create_callbacks(
                                         callback=print_preview_batch,
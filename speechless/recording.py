@@ -1,11 +1,10 @@
 import array
-from itertools import dropwhile
 from pathlib import Path
 from sys import byteorder
 
 import librosa
 import numpy
-from numpy import ndarray, abs, max, flipud, concatenate
+from numpy import ndarray, abs, max, concatenate
 
 from speechless import configuration
 from speechless.labeled_example import LabeledExample, LabeledExampleFromFile
@@ -30,13 +29,14 @@ class Recorder:
         return audio / max(abs(audio))
 
     def _trim_silence(self, audio: ndarray) -> ndarray:
-        def trim_start(sound: ndarray) -> ndarray:
-            return numpy.array(list(dropwhile(lambda x: x < self.silence_threshold_for_not_normalized_sound, sound)))
+        # slice between the first and last sample above the threshold,
+        # instead of dropping samples one by one in Python:
+        above_threshold = numpy.where(audio >= self.silence_threshold_for_not_normalized_sound)[0]
 
-        def trim_end(sound: ndarray) -> ndarray:
-            return flipud(trim_start(flipud(sound)))
+        if len(above_threshold) == 0:
+            return audio[:0]
 
-        return trim_start(trim_end(audio))
+        return audio[above_threshold[0]:above_threshold[-1] + 1]
 
     def record(self):
         """Records from the microphone and returns the data as an array of signed shorts."""
@@ -0,0 +1,28 @@
+import librosa
+import numpy as np
+from unittest import TestCase
+
+
+class FastMelTest(TestCase):
+    def setUp(self):
+        try:
+            from speechless import fast_mel
+        except ImportError:
+            self.skipTest("numba is not installed")
+
+        self.fast_mel = fast_mel
+
+    def test_filters_match_librosa(self):
+        filters = self.fast_mel.mel_filters(16000., 512, 128)
+
+        self.assertTrue(np.allclose(filters, librosa.filters.mel(sr=16000, n_fft=512, n_mels=128), atol=1e-6))
+
+    def test_mel_spectrogram_matches_librosa_dot(self):
+        linear_frequency_spectrogram = np.random.RandomState(42).rand(257, 100).astype(np.float32)
+
+        expected = np.dot(librosa.filters.mel(sr=16000, n_fft=512, n_mels=128), linear_frequency_spectrogram)
+
+        self.assertTrue(np.allclose(
+            self.fast_mel.mel_spectrogram(linear_frequency_spectrogram, sample_rate=16000,
+                                          fourier_window_length=512, mel_frequency_count=128),
+            expected, rtol=1e-4, atol=1e-6))
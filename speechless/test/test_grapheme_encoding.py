@@ -17,6 +17,13 @@ class CtcGraphemeEncodingTests(TestCase):
         graphemes = g.encode("sssshhhheeeee      wasn't thre") + [g.ctc_blank] + g.encode("eeeeee")
         self.assertEqual("she wasn't three", g.decode_graphemes(graphemes))
 
+    def test_encode_unexpected_character(self):
+        g = CtcGraphemeEncoding(english_frequent_characters)
+        with self.assertRaises(ValueError):
+            g.encode("she wasn't three?")
+        with self.assertRaises(ValueError):
+            g.encode("she\twasn't three")
+
     def test_encode_batch(self):
         g = CtcGraphemeEncoding(english_frequent_characters)
         predictions = zeros((2, 3, g.grapheme_set_size))
@@ -16,9 +16,11 @@ class LabeledExampleTest(TestCase):
             y=example.get_raw_audio(), n_fft=example.fourier_window_length, hop_length=example.hop_length,
             sr=example.sample_rate)
 
-        self.assertTrue(np.array_equal(mel_power_spectrogram,
-                                       example.spectrogram(type=SpectrogramType.power,
-                                                           frequency_scale=SpectrogramFrequencyScale.mel)))
+        # tolerance instead of exact equality: the numba fast_mel path computes in float32
+        self.assertTrue(np.allclose(mel_power_spectrogram,
+                                    example.spectrogram(type=SpectrogramType.power,
+                                                        frequency_scale=SpectrogramFrequencyScale.mel),
+                                    rtol=1e-3, atol=1e-6))
 
     def test_serialize_positional_label(self):
         a = PositionalLabel(labeled_sections=[("einmal", (0, 0.55555)), ("von", (0.55555, 0.8))])
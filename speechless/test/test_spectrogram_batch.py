@@ -1,5 +1,12 @@
+import math
+import struct
+import wave
+from pathlib import Path
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 
+from speechless.corpus import Corpus, LabeledSpectrogramBatchGenerator
+from speechless.labeled_example import LabeledExampleFromFile
 from speechless.tools import paginate
 
 
@@ -7,3 +14,27 @@ class ToolsTest(TestCase):
     def test_paginate(self):
         a = paginate([1, 2, 3], 2)
         self.assertEqual(list(a), [[1, 2], [3, ]])
+
+
+class FillCacheTest(TestCase):
+    def test_round_trip_through_pool(self):
+        with TemporaryDirectory() as directory:
+            directory = Path(directory)
+            audio_file = directory / "example.wav"
+
+            with wave.open(str(audio_file), 'w') as writer:
+                writer.setnchannels(1)
+                writer.setsampwidth(2)
+                writer.setframerate(16000)
+                writer.writeframes(b"".join(
+                    struct.pack('<h', int(10000 * math.sin(2 * math.pi * 440 * sample / 16000)))
+                    for sample in range(16000)))
+
+            corpus = Corpus(training_examples=[LabeledExampleFromFile(audio_file, label="test")],
+                            test_examples=[])
+            generator = LabeledSpectrogramBatchGenerator(
+                corpus=corpus, spectrogram_cache_directory=directory / "cache", batch_size=1)
+
+            generator.fill_cache()
+
+            self.assertTrue(all(s.is_cached() for s in generator.labeled_spectrograms))